@@ -1,16 +1,26 @@
 import streamlit as st
-from openai import OpenAI
+from openai import (AsyncOpenAI, DefaultAioHttpClient, APIConnectionError,
+                    InternalServerError, RateLimitError)
 import os
+import asyncio
+import atexit
+import random
+import threading
 import base64
-from streamlit_gsheets import GSheetsConnection
-from pymongo import MongoClient
-from datetime import datetime, timedelta
-import pandas as pd
-import bcrypt
+import logging
+from datetime import datetime, timedelta, timezone
 import re
+import string
 import secrets
+import jwt
+import hashlib
+import json
+import sqlite3
+import time
+import queue
 import streamlit_cookies_manager as scm
 
+logger = logging.getLogger(__name__)
 
 st.set_page_config(
     page_title="AI Meal Planner",
@@ -19,72 +29,94 @@ st.set_page_config(
 )
 
 
+def get_secret(name):
+    """Return a setting from Streamlit secrets, falling back to the environment variable."""
+    value = None
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        pass
+    return value or os.environ.get(name)
+
+
 # Authentication System
+# Validation patterns, compiled once at import
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# Password character classes, checked in a single pass over the password
+UPPERCASE_CHARS = frozenset(string.ascii_uppercase)
+LOWERCASE_CHARS = frozenset(string.ascii_lowercase)
+DIGIT_CHARS = frozenset(string.digits)
+SPECIAL_CHARS = frozenset("!@#$%^&*()_+-=")
+PASSWORD_CLASS_RULES = (
+    (1, "Password must contain at least one uppercase letter"),
+    (2, "Password must contain at least one lowercase letter"),
+    (4, "Password must contain at least one digit"),
+    (8, "Password must contain at least one special character (!@#$%^&*()_+-=)"),
+)
+
+# Stored password hashes with this prefix are bcrypt over base64(sha256(password))
+PREHASH_PREFIX = "sha256$"
+
+
 class AuthManager:
     def __init__(self, db_name="ai_meal_planner", collection_name="users"):
         self.db_name = db_name
         self.collection_name = collection_name
         self.tokens_collection = "auth_tokens"
+        self.bcrypt_cost = int(get_secret("BCRYPT_COST") or 10)
 
     def get_mongo_client(self):
-        """Return a MongoClient using Streamlit secrets or environment variable MONGODB_URI."""
-        mongo_uri = None
-        try:
-            mongo_uri = st.secrets.get("MONGODB_URI")
-        except Exception:
-            pass
-        if not mongo_uri:
-            mongo_uri = os.environ.get("MONGODB_URI")
-        if not mongo_uri:
-            return None
-        try:
-            client = MongoClient(mongo_uri)
-            client.admin.command('ping')
-            return client
-        except Exception:
-            return None
+        """Return the process-wide MongoClient shared with the meal plan functions."""
+        return get_mongo_client()
+
+    def prehash_password(self, password):
+        """Return base64(sha256(password)), avoiding bcrypt's 72-byte and NUL truncation."""
+        return base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
 
     def hash_password(self, password):
-        """Hash password using bcrypt."""
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        """Hash password using bcrypt at the configured cost (BCRYPT_COST, default 10)."""
+        import bcrypt
+        hashed = bcrypt.hashpw(self.prehash_password(password), bcrypt.gensalt(rounds=self.bcrypt_cost))
+        return PREHASH_PREFIX + hashed.decode('utf-8')
 
     def verify_password(self, password, hashed):
-        """Verify password against hash."""
+        """Verify password against hash, accepting legacy hashes without the pre-hash."""
+        import bcrypt
+        if hashed.startswith(PREHASH_PREFIX):
+            return bcrypt.checkpw(self.prehash_password(password), hashed[len(PREHASH_PREFIX):].encode('utf-8'))
         return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+    def needs_rehash(self, hashed):
+        """Return True if hashed is a legacy hash or uses a different bcrypt cost."""
+        if not hashed.startswith(PREHASH_PREFIX):
+            return True
+        # bcrypt hashes look like $2b$<cost>$<salt+hash>
+        return int(hashed[len(PREHASH_PREFIX):].split('$')[2]) != self.bcrypt_cost
+
     def validate_email(self, email):
         """Validate email format."""
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        return re.match(pattern, email) is not None
+        return EMAIL_RE.match(email) is not None
 
     def validate_password(self, password):
         """Validate password strength."""
         if len(password) < 8:
             return False, "Password must be at least 8 characters long"
-        if not re.search(r"[A-Z]", password):
-            return False, "Password must contain at least one uppercase letter"
-        if not re.search(r"[a-z]", password):
-            return False, "Password must contain at least one lowercase letter"
-        if not re.search(r"[0-9]", password):
-            return False, "Password must contain at least one digit"
-        if not re.search(r"[!@#$%^&*()_+-=]", password):
-            return False, "Password must contain at least one special character (!@#$%^&*()_+-=)"
+        flags = 0
+        for c in password:
+            if c in UPPERCASE_CHARS:
+                flags |= 1
+            elif c in LOWERCASE_CHARS:
+                flags |= 2
+            elif c in DIGIT_CHARS:
+                flags |= 4
+            elif c in SPECIAL_CHARS:
+                flags |= 8
+        for flag, message in PASSWORD_CLASS_RULES:
+            if not flags & flag:
+                return False, message
         return True, "Password is valid"
 
-    def user_exists(self, email):
-        """Check if user exists."""
-        client = self.get_mongo_client()
-        if not client:
-            return False
-        try:
-            db = client[self.db_name]
-            users_collection = db[self.collection_name]
-            return users_collection.find_one({"email": email}) is not None
-        except Exception:
-            return False
-        finally:
-            client.close()
-
     def register_user(self, username, email, password):
         """Register a new user."""
         if not self.validate_email(email):
@@ -94,32 +126,35 @@ class AuthManager:
         if not is_valid:
             return False, message
 
-        if self.user_exists(email):
-            return False, "User with this email already exists"
-
         client = self.get_mongo_client()
         if not client:
             return False, "Database connection failed"
+        from pymongo.errors import DuplicateKeyError
 
         try:
             db = client[self.db_name]
             users_collection = db[self.collection_name]
 
+            # The unique index on email rejects duplicates atomically; until it
+            # is confirmed to exist, check for an existing account first
+            if not get_index_status(self.db_name).results.get("users_email"):
+                if users_collection.find_one({"email": email}, {"_id": 1}) is not None:
+                    return False, "User with this email already exists"
+
             user_data = {
                 "username": username,
                 "email": email,
                 "password": self.hash_password(password),
-                "created_at": datetime.now(),
+                "created_at": datetime.now(timezone.utc),
                 "is_active": True
             }
-
             users_collection.insert_one(user_data)
             return True, "User registered successfully"
 
+        except DuplicateKeyError:
+            return False, "User with this email already exists"
         except Exception as e:
             return False, f"Registration failed: {str(e)}"
-        finally:
-            client.close()
 
     def authenticate_user(self, email, password):
         """Authenticate user credentials."""
@@ -131,11 +166,23 @@ class AuthManager:
             db = client[self.db_name]
             users_collection = db[self.collection_name]
 
-            user = users_collection.find_one({"email": email, "is_active": True})
+            user = users_collection.find_one(
+                {"email": email, "is_active": True},
+                {"username": 1, "email": 1, "password": 1}
+            )
             if not user:
                 return False, "Invalid email or password", None
 
             if self.verify_password(password, user["password"]):
+                # Migrate legacy hashes and cost changes on successful login
+                if self.needs_rehash(user["password"]):
+                    try:
+                        users_collection.update_one(
+                            {"_id": user["_id"]},
+                            {"$set": {"password": self.hash_password(password)}}
+                        )
+                    except Exception:
+                        pass
                 return True, "Login successful", {
                     "username": user["username"],
                     "email": user["email"],
@@ -146,12 +193,16 @@ class AuthManager:
 
         except Exception as e:
             return False, f"Authentication failed: {str(e)}", None
-        finally:
-            client.close()
 
-    def generate_token(self, user_id, expiry_days=30):
-        """Generate a secure session token for persistent login."""
-        token = secrets.token_urlsafe(32)
+    def hash_token(self, session_id):
+        """Return the SHA-256 digest stored in place of the session id."""
+        return hashlib.sha256(session_id.encode('utf-8')).digest()
+
+    def generate_token(self, user_info, expiry_days=30):
+        """Generate a signed session token (JWT) for persistent login."""
+        session_id = secrets.token_urlsafe(32)
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(days=expiry_days)
         client = self.get_mongo_client()
         if not client:
             return None
@@ -160,69 +211,89 @@ class AuthManager:
             db = client[self.db_name]
             tokens_collection = db[self.tokens_collection]
 
+            from bson.objectid import ObjectId
             token_data = {
-                "token": token,
-                "user_id": user_id,
-                "created_at": datetime.now(),
-                "expires_at": datetime.now() + timedelta(days=expiry_days)
+                "token": self.hash_token(session_id),
+                "user_id": ObjectId(user_info['user_id']),
+                "created_at": now,
+                "expires_at": expires_at
             }
             tokens_collection.insert_one(token_data)
-            return token
+            return jwt.encode({
+                "jti": session_id,
+                "uid": user_info['user_id'],
+                "u": user_info['username'],
+                "e": user_info['email'],
+                "exp": expires_at,
+            }, get_token_secret(), algorithm="HS256")
 
         except Exception:
             return None
-        finally:
-            client.close()
+
+    def decode_token(self, token, verify_exp=True):
+        """Return the claims of a session token signed by this app, or None."""
+        try:
+            return jwt.decode(token, get_token_secret(), algorithms=["HS256"],
+                              options={"verify_exp": verify_exp})
+        except jwt.InvalidTokenError:
+            return None
 
     def validate_token(self, token):
         """Validate token and return user info if valid."""
         if not token:
             return None
 
-        client = self.get_mongo_client()
-        if not client:
+        claims = self.decode_token(token)
+        if not claims:
             return None
-
         try:
-            db = client[self.db_name]
-            tokens_collection = db[self.tokens_collection]
-            users_collection = db[self.collection_name]
-
-            # Find token and check if it's not expired
-            token_doc = tokens_collection.find_one({
-                "token": token,
-                "expires_at": {"$gt": datetime.now()}
-            })
-
-            if not token_doc:
-                return None
-
-            # Get user info
-            from bson.objectid import ObjectId
-            user = users_collection.find_one({
-                "_id": ObjectId(token_doc["user_id"]),
-                "is_active": True
-            })
-
-            if not user:
+            if not is_session_active(self, claims["jti"]):
                 return None
-
-            return {
-                "username": user["username"],
-                "email": user["email"],
-                "user_id": str(user["_id"])
-            }
-
         except Exception:
+            # Database errors are not cached, so the session is checked again next run
             return None
-        finally:
-            client.close()
+
+        return {
+            "username": claims["u"],
+            "email": claims["e"],
+            "user_id": claims["uid"]
+        }
+
+    def session_is_active(self, session_id):
+        """Return True if the session is unexpired, unrevoked and its user is active."""
+        client = self.get_mongo_client()
+        if not client:
+            raise RuntimeError("Database connection failed")
+
+        db = client[self.db_name]
+        tokens_collection = db[self.tokens_collection]
+
+        # Fetch the unexpired session and its active user in one round-trip
+        pipeline = [
+            {"$match": {"token": self.hash_token(session_id), "expires_at": {"$gt": datetime.now(timezone.utc)}}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": self.collection_name,
+                "let": {"user_id": "$user_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$_id", "$$user_id"]}, "is_active": True}},
+                    {"$project": {"_id": 1}},
+                ],
+                "as": "user",
+            }},
+            {"$unwind": "$user"},
+        ]
+        return next(tokens_collection.aggregate(pipeline), None) is not None
 
     def revoke_token(self, token):
         """Revoke/delete a session token."""
         if not token:
             return
 
+        claims = self.decode_token(token, verify_exp=False)
+        if not claims:
+            return
+
         client = self.get_mongo_client()
         if not client:
             return
@@ -230,27 +301,40 @@ class AuthManager:
         try:
             db = client[self.db_name]
             tokens_collection = db[self.tokens_collection]
-            tokens_collection.delete_one({"token": token})
+            tokens_collection.delete_one({"token": self.hash_token(claims["jti"])})
         except Exception:
             pass
         finally:
-            client.close()
+            is_session_active.clear(self, claims["jti"])
+
+
+@st.cache_resource
+def get_token_secret():
+    """Return the session-token signing key (AUTH_SECRET_KEY, else random per process)."""
+    return get_secret("AUTH_SECRET_KEY") or secrets.token_urlsafe(32)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def is_session_active(_auth_manager, session_id):
+    """Check a session against MongoDB, remembering the answer for five minutes."""
+    return _auth_manager.session_is_active(session_id)
 
 
 def init_session_state():
     """Initialize session state variables for authentication."""
-    if 'authenticated' not in st.session_state:
-        st.session_state.authenticated = False
-    if 'user_info' not in st.session_state:
-        st.session_state.user_info = None
-    if 'show_register' not in st.session_state:
-        st.session_state.show_register = False
-    if 'history' not in st.session_state:
-        st.session_state.history = []
-    if 'latest_plan' not in st.session_state:
-        st.session_state.latest_plan = None
-    if 'auth_token' not in st.session_state:
-        st.session_state.auth_token = None
+    # Built per call so each session gets its own history list.
+    defaults = (
+        ("authenticated", False),
+        ("user_info", None),
+        ("show_register", False),
+        ("history", []),
+        ("latest_plan", None),
+        ("history_last_id", None),
+        ("hist_window", HISTORY_WINDOW),
+        ("auth_token", None),
+    )
+    for key, value in defaults:
+        st.session_state.setdefault(key, value)
 
 
 def show_login_form(auth_manager, cookies):
@@ -279,7 +363,7 @@ def show_login_form(auth_manager, cookies):
                     
                     # Generate and store token if remember me is checked
                     if remember_me:
-                        token = auth_manager.generate_token(user_info['user_id'])
+                        token = auth_manager.generate_token(user_info)
                         if token:
                             st.session_state.auth_token = token
                             cookies['auth_token'] = token
@@ -373,6 +457,9 @@ def show_user_info(auth_manager, cookies):
                 # Clear meal plan history on logout for security
                 st.session_state.history = []
                 st.session_state.latest_plan = None
+                # Drop unsaved plans so they are not flushed by the next user's save
+                st.session_state.pop("pending_mongo_docs", None)
+                st.session_state.pop("pending_sheet_rows", None)
                 st.success("Logged out successfully!")
                 st.rerun()
 
@@ -421,55 +508,163 @@ def get_current_user_id():
     return None
 
 
-# Initialize OpenAI client (same as original)
+# Most recent plans kept in the session's history, and how many the sidebar shows at a time
+MAX_HISTORY_ENTRIES = 50
+HISTORY_WINDOW = 20
+
+
+def show_older_history():
+    """Widen the sidebar history window by another HISTORY_WINDOW entries."""
+    st.session_state.hist_window += HISTORY_WINDOW
+
+
+def build_history_entry(title, content, inputs, plan_id=None, created=None):
+    """Return a history entry with its markdown and caption pre-rendered."""
+    has_content = content is not None
+    return {
+        "id": plan_id,
+        "key": plan_id or secrets.token_hex(8),
+        "created": created if created is not None else time.time(),
+        "title": title,
+        "content": content,
+        "inputs": inputs,
+        "content_md": content.replace('\n', '  \n') if has_content else None,
+        "plan_md": (content + "\n\n" + title).replace('\n', '  \n') if has_content else None,
+        "caption_md": (
+            f":small[Kcal: {inputs['kcal']} · "
+            f"Strict Ingredients: {'Yes' if inputs['exact_ingredients'] else 'No'}]"
+        ),
+    }
+
+
+# Shared event loop and OpenAI client
+# The OpenAI client's connection pool is bound to this loop, so its coroutines
+# must be scheduled with run_async() rather than asyncio.run()
+@st.cache_resource
+def get_event_loop():
+    """Return a process-wide event loop running in a background thread."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+@st.cache_resource
+def get_openai_client(api_key):
+    """Return a process-wide AsyncOpenAI client using the aiohttp transport."""
+    # Retries are handled by generate_meal_plan together with the rate limiter
+    aclient = AsyncOpenAI(api_key=api_key, http_client=DefaultAioHttpClient(), max_retries=0)
+    atexit.register(lambda: run_async(aclient.close()))
+    return aclient
+
+
+# OpenAI request budget shared by all sessions of this process
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 200_000
+MAX_ATTEMPTS = 5
+
+
+class RateLimiter:
+    """Token bucket for requests and tokens per minute, shared across coroutines."""
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute
+        self.available_tokens = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(self.max_requests, self.available_requests + self.max_requests * elapsed / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + self.max_tokens * elapsed / 60)
+        self.last_update = now
+
+    async def acquire(self, tokens):
+        """Wait until one request and the estimated tokens fit in the budget, then spend them."""
+        tokens = min(tokens, self.max_tokens)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens,
+                )
+                await asyncio.sleep(max(wait, 0.01))
+
+
+@st.cache_resource
+def get_rate_limiter():
+    """Return the process-wide OpenAI rate limiter."""
+    return RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+
 try:
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-except (KeyError, AttributeError):
-    try:
-        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    except Exception:
-        st.error("OpenAI API key not found. Please set it in Streamlit secrets or as an environment variable.")
-        st.stop()
+    aclient = get_openai_client(get_secret("OPENAI_API_KEY"))
+except Exception:
+    st.error("OpenAI API key not found. Please set it in Streamlit secrets or as an environment variable.")
+    st.stop()
+rate_limiter = get_rate_limiter()
 
 
-# Google Sheets functions (same as original)
+# Google Sheets functions
 WORKSHEET_NAME = "MealPlans"
 
+
+@st.cache_resource
+def get_worksheet(worksheet_name=WORKSHEET_NAME):
+    """Return the saved-plans worksheet from [connections.gsheets], authenticating once per process."""
+    import gspread
+
+    config = dict(st.secrets["connections"]["gsheets"])
+    spreadsheet = config.pop("spreadsheet")
+    config.pop("worksheet", None)
+    gc = gspread.service_account_from_dict(config)
+    if spreadsheet.startswith("http"):
+        sh = gc.open_by_url(spreadsheet)
+    else:
+        sh = gc.open_by_key(spreadsheet)
+    return sh.worksheet(worksheet_name)
+
+
 def save_to_sheet(data):
+    """Append the plan, and any rows that failed earlier in the session, to the worksheet."""
     if not data:
         st.error("No data to save.")
         return False
     try:
-        conn = st.connection("gsheets", type=GSheetsConnection)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = datetime.now(timezone.utc).isoformat(timespec="seconds")
 
         # Add user information to the data
         user_info = st.session_state.user_info
         user_id = user_info['user_id'] if user_info else 'anonymous'
         username = user_info['username'] if user_info else 'anonymous'
 
-        new_row = pd.DataFrame(
-            [
-                {
-                    "Timestamp": timestamp,
-                    "User ID": user_id,
-                    "Username": username,
-                    "Titles": data['title'],
-                    "Calorie Goal": data['inputs']['kcal'],
-                    "Ingredients Input": data['inputs']['ingredients'],
-                    "Full Plan": data['content']
-                }
-            ]
-        )
-
-        try:
-            existing_data = conn.read(worksheet=WORKSHEET_NAME, usecols=list(range(7)), ttl="5s")
-            existing_data = existing_data.dropna(how="all")
-        except Exception:
-            existing_data = pd.DataFrame()
-
-        updated_df = pd.concat([existing_data, new_row], ignore_index=True)
-        conn.update(worksheet=WORKSHEET_NAME, data=updated_df)
+        row = [
+            timestamp,
+            user_id,
+            username,
+            data['title'],
+            data['inputs']['kcal'],
+            data['inputs']['ingredients'],
+            data['content'],
+        ]
+        pending = st.session_state.setdefault("pending_sheet_rows", [])
+        if all(row[1:] != r[1:] for r in pending):
+            pending.append(row)
+
+        get_worksheet().append_rows(pending, value_input_option="RAW")
+        pending.clear()
         return True
     except Exception as e:
         st.error(f"An error occurred while saving to Google Sheets: {e}")
@@ -477,27 +672,82 @@ def save_to_sheet(data):
 
 
 # MongoDB functions (updated to be user-specific)
-def get_mongo_client():
-    """Return a MongoClient using Streamlit secrets or environment variable MONGODB_URI."""
-    mongo_uri = None
+class IndexStatus:
+    """Outcome of each index creation in this process: True if created, False if it failed for good."""
+
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+
+@st.cache_resource
+def get_index_status(db_name):
+    """Return the process-wide IndexStatus for db_name."""
+    return IndexStatus()
+
+
+def ensure_indexes(client, db_name="ai_meal_planner"):
+    """Create the indexes the app's queries rely on that this process has not tried yet."""
+    from pymongo import ASCENDING, DESCENDING
+    from pymongo.errors import ConnectionFailure
+
+    status = get_index_status(db_name)
+    indexes = [
+        # History is filtered by user and sorted newest first
+        ("meal_plans_user_timestamp", "meal_plans", [("user_id", ASCENDING), ("timestamp", DESCENDING)], {}),
+        # Login and registration look users up by email
+        ("users_email", "users", [("email", ASCENDING)], {"unique": True}),
+        # Session cookies are looked up by token; expired tokens are purged by MongoDB
+        ("auth_tokens_token", "auth_tokens", [("token", ASCENDING)], {"unique": True}),
+        ("auth_tokens_expires_at", "auth_tokens", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ]
+    if all(name in status.results for name, *_ in indexes):
+        return
+    # Another session is already creating them
+    if not status.lock.acquire(blocking=False):
+        return
     try:
-        mongo_uri = st.secrets.get("MONGODB_URI")
-    except Exception:
-        pass
-    if not mongo_uri:
-        mongo_uri = os.environ.get("MONGODB_URI")
+        db = client[db_name]
+        for name, collection_name, keys, options in indexes:
+            if name in status.results:
+                continue
+            try:
+                db[collection_name].create_index(keys, **options)
+                status.results[name] = True
+            except ConnectionFailure as e:
+                # The server is unreachable; the remaining indexes would fail the same way
+                logger.warning("Could not reach MongoDB to create indexes: %s", e)
+                return
+            except Exception as e:
+                logger.warning("Could not create index %s on %s: %s", name, collection_name, e)
+                status.results[name] = False
+    finally:
+        status.lock.release()
+
+
+@st.cache_resource
+def _get_mongo_client(mongo_uri):
+    """Return a process-wide MongoClient; PyMongo pools connections internally."""
+    from pymongo import MongoClient
+
+    return MongoClient(mongo_uri, maxPoolSize=20, serverSelectionTimeoutMS=2000, retryWrites=True)
+
+
+def get_mongo_client():
+    """Return the shared MongoClient using Streamlit secrets or environment variable MONGODB_URI."""
+    mongo_uri = get_secret("MONGODB_URI")
     if not mongo_uri:
         return None
     try:
-        client = MongoClient(mongo_uri)
-        client.admin.command('ping')
-        return client
+        client = _get_mongo_client(mongo_uri)
     except Exception:
         return None
+    ensure_indexes(client)
+    return client
 
 
 def save_to_mongo(data, db_name="ai_meal_planner", collection_name="meal_plans"):
-    """Save the plan to MongoDB with user information."""
+    """Save the plan, and any that failed earlier in the session, to MongoDB with user information."""
     if not data:
         st.error("No data to save.")
         return False
@@ -511,13 +761,16 @@ def save_to_mongo(data, db_name="ai_meal_planner", collection_name="meal_plans")
     if not client:
         st.error("MongoDB URI not found or connection failed. Set MONGODB_URI in Streamlit secrets or environment variables.")
         return False
+    from pymongo import WriteConcern
+    from pymongo.errors import BulkWriteError
+
     try:
         db = client[db_name]
         coll = db[collection_name]
         doc = {
             "user_id": user_id,  # Add user_id to make data user-specific
             "username": st.session_state.user_info['username'],
-            "timestamp": datetime.now(),
+            "timestamp": datetime.now(timezone.utc),
             "title": data['title'],
             "calorie_goal": data['inputs']['kcal'],
             "ingredients_input": data['inputs']['ingredients'],
@@ -525,80 +778,521 @@ def save_to_mongo(data, db_name="ai_meal_planner", collection_name="meal_plans")
             "extra": data['inputs'].get('extra'),
             "full_plan": data['content']
         }
-        coll.insert_one(doc)
+        pending = st.session_state.setdefault("pending_mongo_docs", [])
+        key = (doc["user_id"], doc["title"], doc["full_plan"])
+        queued = next((d for d in pending if (d["user_id"], d["title"], d["full_plan"]) == key), None)
+        if queued is None:
+            pending.append(doc)
+        else:
+            doc = queued  # already queued by a failed save; its _id is the one to record
+
+        try:
+            coll.with_options(write_concern=WriteConcern(w=1)).insert_many(pending, ordered=False)
+        except BulkWriteError as e:
+            # insert_many assigns _id up front, so duplicate keys were saved by an earlier attempt
+            retry = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+            pending[:] = [d for i, d in enumerate(pending) if i in retry]
+            if pending:
+                raise
+        pending.clear()
+        if "_id" in doc:
+            # insert_many filled in the id; a later refresh then recognizes this plan
+            data["id"] = str(doc["_id"])
+        invalidate_history(user_id)
         return True
     except Exception as e:
         st.error(f"An error occurred while saving to MongoDB: {e}")
         return False
 
 
-def load_from_mongo(limit=10, db_name="ai_meal_planner", collection_name="meal_plans"):
-    """Load recent meal plans from MongoDB for the current user only."""
-    user_id = get_current_user_id()
-    if not user_id:
+# Fields needed to list a plan in the sidebar history
+HISTORY_PROJECTION = {
+    "title": 1, "timestamp": 1,
+    "calorie_goal": 1, "kcal": 1,
+    "exact_ingredients": 1,
+}
+
+# Fields needed to display a full plan (including legacy field names)
+PLAN_PROJECTION = {
+    "title": 1, "full_plan": 1, "content": 1,
+    "ingredients_input": 1, "ingredients": 1,
+    "calorie_goal": 1, "kcal": 1,
+    "exact_ingredients": 1, "extra": 1,
+}
+
+
+def history_entry_from_doc(d, with_content=True):
+    """Build a history entry from a meal_plans document."""
+    return build_history_entry(
+        title=d.get("title") or f"Plan {d.get('_id')}",
+        content=(d.get("full_plan") or d.get("content") or "") if with_content else None,
+        inputs={
+            "ingredients": d.get("ingredients_input") or d.get("ingredients") or "",
+            "kcal": d.get("calorie_goal") or d.get("kcal") or 0,
+            "exact_ingredients": d.get("exact_ingredients", False),
+            "extra": d.get("extra") or None,
+        },
+        plan_id=str(d["_id"]),
+        created=d["_id"].generation_time.timestamp()
+    )
+
+
+@st.cache_resource
+def get_history_revisions():
+    """Return a process-wide map of user id to the revision of their saved plans."""
+    return {}
+
+
+def invalidate_history(user_id):
+    """Make the next history load for user_id skip its cached results."""
+    get_history_revisions()[user_id] = time.time_ns()
+
+
+# The cached loaders below, like AuthManager.session_is_active, let database
+# errors propagate instead of returning an empty result, so a failure is never
+# cached. revision only keys the cache; see invalidate_history.
+@st.cache_data(ttl=60, show_spinner=False)
+def load_plans_for_user(user_id, limit=10, db_name="ai_meal_planner", collection_name="meal_plans",
+                        since_id=None, revision=0):
+    """Load a user's recent plan titles from MongoDB, optionally only those after since_id."""
+    from bson.objectid import ObjectId
+
+    client = get_mongo_client()
+    if not client:
         return []
+    coll = client[db_name][collection_name]
+    # Only load plans for the current user
+    query = {"user_id": user_id}
+    if since_id:
+        query["_id"] = {"$gt": ObjectId(since_id)}
+    cursor = (
+        coll.find(query, HISTORY_PROJECTION)
+        .sort("timestamp", -1)
+        .limit(limit)
+        .batch_size(limit)  # fetch the whole page in the first batch
+    )
+    return [history_entry_from_doc(d, with_content=False) for d in cursor]
+
+
+@st.cache_data(max_entries=100, show_spinner=False)
+def load_plan_for_user(user_id, plan_id, db_name="ai_meal_planner", collection_name="meal_plans"):
+    """Load one of a user's saved plans with its full content, or None if not found."""
+    from bson.objectid import ObjectId
 
     client = get_mongo_client()
     if not client:
+        return None
+    coll = client[db_name][collection_name]
+    d = coll.find_one({"_id": ObjectId(plan_id), "user_id": user_id}, PLAN_PROJECTION)
+    return history_entry_from_doc(d) if d else None
+
+
+def load_from_mongo(limit=10, db_name="ai_meal_planner", collection_name="meal_plans", since_id=None):
+    """Load recent meal plans from MongoDB for the current user only."""
+    user_id = get_current_user_id()
+    if not user_id:
         return []
+
     try:
-        coll = client[db_name][collection_name]
-        # Only load plans for the current user
-        cursor = coll.find({"user_id": user_id}).sort("timestamp", -1).limit(limit)
-        entries = []
-        for d in cursor:
-            entry = {
-                "title": d.get("title") or f"Plan {d.get('_id')}",
-                "content": d.get("full_plan") or d.get("content") or "",
-                "inputs": {
-                    "ingredients": d.get("ingredients_input") or d.get("ingredients") or "",
-                    "kcal": d.get("calorie_goal") or d.get("kcal") or 0,
-                    "exact_ingredients": d.get("exact_ingredients", False),
-                    "extra": d.get("extra") or None,
-                }
-            }
-            entries.append(entry)
+        revision = get_history_revisions().get(user_id, 0)
+        entries = load_plans_for_user(user_id, limit, db_name, collection_name, since_id, revision)
+        if entries:
+            entries[0] = load_plan_for_user(user_id, entries[0]["id"], db_name, collection_name) or entries[0]
         return entries
     except Exception as e:
         st.error(f"Failed to load from MongoDB: {e}")
         return []
 
 
-# Meal plan generation function (same as original)
-def generate_meal_plan(ingredients, kcal=2000, exact_ingredients=False,
-                       output_format='text', model='gpt-3.5-turbo',
-                       system_role='You are a skilled cook with expertise of a chef.',
-                       temperature=1, extra=None):
-    prompt = f"""
+def load_plan_by_id(plan_id, db_name="ai_meal_planner", collection_name="meal_plans"):
+    """Load one of the current user's saved plans with its full content."""
+    user_id = get_current_user_id()
+    if not user_id:
+        return None
+
+    try:
+        return load_plan_for_user(user_id, plan_id, db_name, collection_name)
+    except Exception as e:
+        st.error(f"Failed to load from MongoDB: {e}")
+        return None
+
+
+# Meal plan response caches (exact match on inputs, and semantic near-duplicates)
+PLAN_CACHE_TTL = 24 * 60 * 60
+SEMANTIC_CACHE_TTL = 7 * 24 * 60 * 60
+SEMANTIC_CACHE_MAX_DISTANCE = 0.05
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+class PlanCache:
+    """SQLite connection for cached meal plans, shared by all sessions under lock."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.semantic = False
+
+
+@st.cache_resource
+def get_plan_cache():
+    """Return the process-wide PlanCache, loading sqlite-vec when the Python build allows."""
+    path = os.environ.get("PLAN_CACHE_PATH") or os.path.join(os.path.dirname(__file__), "plan_cache.db")
+    cache = PlanCache(path)
+    conn = cache.conn
+    try:
+        import sqlite_vec
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+        cache.semantic = True
+    except (ImportError, AttributeError, sqlite3.Error):
+        pass
+    conn.execute("CREATE TABLE IF NOT EXISTS plan_cache (key TEXT PRIMARY KEY, response TEXT, ts REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS semantic_cache (namespace TEXT, embedding BLOB, response TEXT, ts REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS semantic_cache_namespace ON semantic_cache (namespace, ts)")
+    # Expired rows are purged by timestamp on every write
+    conn.execute("CREATE INDEX IF NOT EXISTS plan_cache_ts ON plan_cache (ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS semantic_cache_ts ON semantic_cache (ts)")
+    conn.commit()
+    return cache
+
+
+def semantic_cache_enabled():
+    """Return True if the plan cache opened and sqlite-vec is loaded."""
+    try:
+        return get_plan_cache().semantic
+    except sqlite3.Error:
+        return False
+
+
+def plan_cache_key(prompt, variant=0):
+    """Hash the generation kwargs (and variant number) into a cache key."""
+    payload = json.dumps({"prompt": prompt, "variant": variant}, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8')).hexdigest()
+
+
+def get_cached_plan(key, ttl=PLAN_CACHE_TTL):
+    """Return the cached response for key, or None if missing or expired."""
+    try:
+        cache = get_plan_cache()
+        with cache.lock:
+            row = cache.conn.execute(
+                "SELECT response FROM plan_cache WHERE key = ? AND ts > ?",
+                (key, time.time() - ttl)
+            ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+def put_cached_plan(key, response):
+    """Store a generated response under key, dropping expired ones."""
+    try:
+        cache = get_plan_cache()
+        now = time.time()
+        with cache.lock, cache.conn:
+            cache.conn.execute("DELETE FROM plan_cache WHERE ts < ?", (now - PLAN_CACHE_TTL,))
+            cache.conn.execute(
+                "INSERT OR REPLACE INTO plan_cache (key, response, ts) VALUES (?, ?, ?)",
+                (key, response, now)
+            )
+    except sqlite3.Error:
+        pass
+
+
+def semantic_cache_text(prompt):
+    """Normalize the ingredient list so reordered or re-cased lists embed alike."""
+    lines = {line.strip().lower() for line in prompt["ingredients"].splitlines() if line.strip()}
+    return ", ".join(sorted(lines))
+
+
+def semantic_cache_namespace(prompt):
+    """Bucket similar-plan reuse by calorie range, strictness and extra requirements."""
+    return json.dumps([
+        int(prompt.get("kcal", 2000)) // 250,
+        bool(prompt.get("exact_ingredients", False)),
+        (prompt.get("extra") or "").strip().lower(),
+    ])
+
+
+def get_similar_plans(namespace, embedding, limit=1, ttl=SEMANTIC_CACHE_TTL,
+                      max_distance=SEMANTIC_CACHE_MAX_DISTANCE):
+    """Return up to limit cached responses whose embedding is close to embedding."""
+    try:
+        import sqlite_vec
+        vector = sqlite_vec.serialize_float32(embedding)
+        cache = get_plan_cache()
+        with cache.lock:
+            rows = cache.conn.execute(
+                "SELECT response FROM semantic_cache "
+                "WHERE namespace = ? AND ts > ? AND vec_distance_cosine(embedding, ?) < ? "
+                "ORDER BY vec_distance_cosine(embedding, ?) LIMIT ?",
+                (namespace, time.time() - ttl, vector, max_distance, vector, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+    except (ImportError, sqlite3.Error):
+        return []
+
+
+def put_similar_plan(namespace, embedding, response):
+    """Store a generated response for later similar-plan lookups, dropping expired ones."""
+    try:
+        import sqlite_vec
+        cache = get_plan_cache()
+        now = time.time()
+        with cache.lock, cache.conn:
+            cache.conn.execute("DELETE FROM semantic_cache WHERE ts < ?", (now - SEMANTIC_CACHE_TTL,))
+            cache.conn.execute(
+                "INSERT INTO semantic_cache (namespace, embedding, response, ts) VALUES (?, ?, ?, ?)",
+                (namespace, sqlite_vec.serialize_float32(embedding), response, now)
+            )
+    except (ImportError, sqlite3.Error):
+        pass
+
+
+# Meal plan prompt, filled in per request with str.format_map
+MEAL_PLAN_PROMPT_TEMPLATE = """
 Create a healthy daily meal plan for breakfast, lunch, and dinner based on the following ingredients: ```{ingredients}```
 Your output should be in the {output_format} format.
 
 ### Instructions:
-1. {'Use ONLY the provided ingredients with salt, pepper, and spices.' if exact_ingredients else 'Feel free to incorporate other common pantry staples.'}
+1. {ingredients_rule}
 2. Specify the exact amount of each ingredient.
 3. Ensure that the total daily calorie intake is below {kcal}.
 4. For each meal, explain each recipe step-by-step in clear sentences.
 5. For each meal, specify the total calories and the number of servings.
 6. For each meal, provide a concise, descriptive title.
 7. For each recipe, indicate the prep, cook and total time.
-{'8. If possible the meals should be: ' + extra if extra else ''}
+{extra_rule}
 9. Separate the recipes with 50 dashes.
 The last line of your answer must be a string containing ONLY the titles of the recipes separated by a comma.
 Example: '\nBroccoli and Egg Scramble, Grilled Chicken and Vegetable, Baked Fish and Cabbage Slaw'.
 """
+
+# Instruction 1, indexed by exact_ingredients
+INGREDIENT_RULES = (
+    'Feel free to incorporate other common pantry staples.',
+    'Use ONLY the provided ingredients with salt, pepper, and spices.',
+)
+
+
+# Limits applied to the ingredient list before it is sent to the model
+MAX_INGREDIENT_LINES = 30
+MAX_INGREDIENT_CHARS = 60
+MAX_INGREDIENT_TOKENS = 1500
+
+# Rough size of a generated plan, counted against the tokens-per-minute budget
+EXPECTED_COMPLETION_TOKENS = 1000
+
+
+@st.cache_resource
+def get_token_encoding(model='gpt-3.5-turbo'):
+    """Return the tiktoken encoding for model, loaded once per process."""
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+def estimate_tokens(text, model='gpt-3.5-turbo'):
+    """Count the tokens in text, or approximate them if tiktoken is unavailable."""
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {'role': 'system', 'content': system_role},
-                {'role': 'user', 'content': prompt}
-            ],
-            temperature=temperature
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"An error occurred while generating the meal plan: {e}")
-        return None
+        return len(get_token_encoding(model).encode(text))
+    except Exception:
+        return len(text) // 4
+
+
+def clean_ingredients(ingredients, model='gpt-3.5-turbo'):
+    """Dedupe and cap the ingredient list; return it with the limits that cut it."""
+    lines = list(dict.fromkeys(line.strip() for line in ingredients.splitlines() if line.strip()))
+    kept = lines[:MAX_INGREDIENT_LINES]
+    limits = []
+    if len(lines) > len(kept):
+        limits.append(f"{MAX_INGREDIENT_LINES} unique lines")
+    if any(len(line) > MAX_INGREDIENT_CHARS for line in kept):
+        limits.append(f"{MAX_INGREDIENT_CHARS} characters per line")
+    cleaned = "\n".join(line[:MAX_INGREDIENT_CHARS] for line in kept)
+    try:
+        encoding = get_token_encoding(model)
+        tokens = encoding.encode(cleaned)
+        if len(tokens) > MAX_INGREDIENT_TOKENS:
+            cleaned = encoding.decode(tokens[:MAX_INGREDIENT_TOKENS])
+            limits.append(f"{MAX_INGREDIENT_TOKENS} tokens in total")
+    except Exception:
+        pass
+    return cleaned, limits
+
+
+# Meal plan generation functions
+async def generate_meal_plan(ingredients, kcal=2000, exact_ingredients=False,
+                             output_format='text', model='gpt-3.5-turbo',
+                             system_role='You are a skilled cook with expertise of a chef.',
+                             temperature=1, extra=None, stream=False):
+    """Generate a meal plan and return its text (or the chunk stream with stream=True)."""
+    prompt = MEAL_PLAN_PROMPT_TEMPLATE.format_map({
+        "ingredients": ingredients,
+        "output_format": output_format,
+        "ingredients_rule": INGREDIENT_RULES[bool(exact_ingredients)],
+        "kcal": kcal,
+        "extra_rule": f"8. If possible the meals should be: {extra}" if extra else "",
+    })
+    messages = [
+        {'role': 'system', 'content': system_role},
+        {'role': 'user', 'content': prompt}
+    ]
+    estimated_tokens = estimate_tokens(system_role + prompt, model) + EXPECTED_COMPLETION_TOKENS
+
+    for attempt in range(MAX_ATTEMPTS):
+        await rate_limiter.acquire(estimated_tokens)
+        try:
+            response = await aclient.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=stream
+            )
+            break
+        except (RateLimitError, APIConnectionError, InternalServerError):
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(2 ** attempt + random.random(), 30))
+
+    if stream:
+        return response
+    return response.choices[0].message.content
+
+
+def stream_meal_plan(prompt):
+    """Yield meal plan text chunks as OpenAI streams them."""
+    chunks = queue.Queue()
+
+    async def _pump():
+        stream = None
+        try:
+            stream = await generate_meal_plan(**prompt, stream=True)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.put(chunk.choices[0].delta.content)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(None)
+            if stream is not None:
+                # Also reached on cancellation: stop the response so no more tokens are billed
+                await stream.close()
+
+    future = asyncio.run_coroutine_threadsafe(_pump(), get_event_loop())
+    try:
+        while (chunk := chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # The page stopped reading (e.g. a rerun closed this generator)
+        future.cancel()
+
+
+async def embed_texts(texts):
+    """Return one embedding vector per text."""
+    response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    return [item.embedding for item in response.data]
+
+
+async def generate_meal_plans_batch(prompts, max_concurrent=10):
+    """Generate one meal plan per kwargs dict in prompts concurrently."""
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def _generate(kwargs):
+        async with semaphore:
+            return await generate_meal_plan(**kwargs)
+
+    return await asyncio.gather(*[_generate(p) for p in prompts], return_exceptions=True)
+
+
+def generate_meal_plans(prompts, allow_similar=False, stream_to=None):
+    """Return one meal plan per kwargs dict in prompts, serving repeats from cache."""
+    keys = [plan_cache_key(p, variant) for variant, p in enumerate(prompts)]
+    results = [get_cached_plan(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+
+    embeddings = {}
+    # Without sqlite-vec no lookup can hit, so don't pay for the embeddings
+    if allow_similar and misses and semantic_cache_enabled():
+        try:
+            texts = [semantic_cache_text(prompts[i]) for i in misses]
+            embeddings = dict(zip(misses, run_async(embed_texts(texts))))
+        except Exception:
+            embeddings = {}
+        similar = {}
+        for i in misses:
+            if i not in embeddings:
+                continue
+            namespace = semantic_cache_namespace(prompts[i])
+            group = (namespace, semantic_cache_text(prompts[i]))
+            if group not in similar:
+                similar[group] = get_similar_plans(namespace, embeddings[i], limit=len(prompts))
+            if similar[group]:
+                results[i] = similar[group].pop(0)
+        misses = [i for i in misses if results[i] is None]
+
+    if not misses:
+        return results
+
+    if len(misses) == 1 and stream_to:
+        try:
+            generated = [stream_to(stream_meal_plan(prompts[misses[0]]))]
+        except Exception as e:
+            generated = [e]
+    else:
+        generated = run_async(generate_meal_plans_batch([prompts[i] for i in misses]))
+
+    for i, meal_plan in zip(misses, generated):
+        results[i] = meal_plan
+        if meal_plan and not isinstance(meal_plan, Exception):
+            put_cached_plan(keys[i], meal_plan)
+            if i in embeddings:
+                put_similar_plan(semantic_cache_namespace(prompts[i]), embeddings[i], meal_plan)
+    return results
+
+
+@st.cache_resource(show_spinner=False)
+def background_css(image_path=None, image_url=None, opacity=0.65):
+    """Build the background CSS once per process; None if no image is available."""
+    if image_url:
+        bg = image_url
+    elif image_path and os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            data = base64.b64encode(f.read()).decode()
+        ext = os.path.splitext(image_path)[1].lower()
+        mime = "image/png" if ext in [".png"] else "image/jpeg"
+        bg = f"data:{mime};base64,{data}"
+    else:
+        return None  # no image provided
+
+    overlay_alpha = 1.0 - float(opacity)
+    css = f"""
+    <style>
+    .stApp {{
+        background-image: url("{bg}");
+        background-size: cover;
+        background-position: center;
+        background-attachment: fixed;
+    }}
+    /* subtle overlay to keep content readable */
+    .stApp::before {{
+        content: "";
+        position: fixed;
+        inset: 0;
+        background: rgba(255,255,255,{overlay_alpha});
+        pointer-events: none;
+        z-index: 0;
+    }}
+    /* ensure main content sits above the overlay */
+    .main .block-container, .css-1lcbmhc, .css-k1vhr4 {{
+        position: relative;
+        z-index: 1;
+    }}
+    </style>
+    """
+    return css
 
 
 def set_background(image_path=None, image_url=None, opacity=0.65):
@@ -608,56 +1302,16 @@ def set_background(image_path=None, image_url=None, opacity=0.65):
     - opacity: overlay darkness (0.0 = transparent, 1.0 = solid white overlay)
     """
     try:
-        if image_url:
-            bg = image_url
-        elif image_path and os.path.exists(image_path):
-            with open(image_path, "rb") as f:
-                data = base64.b64encode(f.read()).decode()
-            ext = os.path.splitext(image_path)[1].lower()
-            mime = "image/png" if ext in [".png"] else "image/jpeg"
-            bg = f"data:{mime};base64,{data}"
-        else:
-            return  # no image provided
-
-        overlay_alpha = 1.0 - float(opacity)
-        css = f"""
-        <style>
-        .stApp {{
-            background-image: url("{bg}");
-            background-size: cover;
-            background-position: center;
-            background-attachment: fixed;
-        }}
-        /* subtle overlay to keep content readable */
-        .stApp::before {{
-            content: "";
-            position: fixed;
-            inset: 0;
-            background: rgba(255,255,255,{overlay_alpha});
-            pointer-events: none;
-            z-index: 0;
-        }}
-        /* ensure main content sits above the overlay */
-        .main .block-container, .css-1lcbmhc, .css-k1vhr4 {{
-            position: relative;
-            z-index: 1;
-        }}
-        </style>
-        """
-        st.markdown(css, unsafe_allow_html=True)
+        css = background_css(image_path=image_path, image_url=image_url, opacity=opacity)
+        if css:
+            st.markdown(css, unsafe_allow_html=True)
     except Exception as e:
         st.warning(f"Background image not applied: {e}")
 
 
 def set_bg_from_config(default_local="background.jpg"):
     """Try to set background from Streamlit secrets, env var, or a local file."""
-    img_url = None
-    try:
-        img_url = st.secrets.get("BACKGROUND_IMAGE_URL")
-    except Exception:
-        pass
-    if not img_url:
-        img_url = os.environ.get("BACKGROUND_IMAGE_URL")
+    img_url = get_secret("BACKGROUND_IMAGE_URL")
 
     if img_url:
         set_background(image_url=img_url, opacity=0.65)
@@ -670,6 +1324,74 @@ def set_bg_from_config(default_local="background.jpg"):
 
 
 # Main Application
+@st.fragment
+def show_history_sidebar():
+    """Display the generation history in a fragment; call inside `with st.sidebar:`."""
+    ss = st.session_state
+    st.title("📜 Your Generation History")
+    if st.button("🔄 Refresh from Database", key="btn_load_plans"):
+        with st.spinner("Loading from database..."):
+            invalidate_history(get_current_user_id())
+            # Only fetch plans saved since the newest one already in the history
+            since_id = ss.history_last_id if ss.history else None
+            loaded = load_from_mongo(limit=50, since_id=since_id)
+            if loaded:
+                ss.history_last_id = loaded[0]['id']
+            known_ids = {e['id'] for e in ss.history}
+            new_entries = [e for e in loaded if e['id'] not in known_ids]
+            if new_entries:
+                # Plans saved elsewhere may be older than ones generated here
+                merged = sorted(new_entries + ss.history, key=lambda e: e['created'], reverse=True)
+                ss.history = merged[:MAX_HISTORY_ENTRIES]
+                st.toast(f"✅ Loaded {len(new_entries)} new plans from your account.")
+                newest = ss.history[0]
+                if newest is not ss.latest_plan:
+                    # Only the newest loaded plan comes with its content
+                    if newest['content_md'] is None:
+                        newest = load_plan_by_id(newest['id']) or newest
+                        ss.history[0] = newest
+                    if newest['content_md'] is not None:
+                        ss.latest_plan = newest
+                        st.rerun()
+            elif ss.history:
+                st.info("Your history is already up to date.")
+            else:
+                st.info("No plans found in database.")
+
+    if st.button("🗑️ Clear History", key="btn_clear_history") and ss.history:
+        ss.history = []
+        ss.latest_plan = None
+        ss.history_last_id = None
+        ss.hist_window = HISTORY_WINDOW
+        st.rerun()
+
+    if not ss.history:
+        st.info("Your generated meal plans will appear here.")
+    else:
+        # Only the newest entries are listed; older ones stay in memory
+        window = ss.hist_window
+        visible = ss.history[:window]
+        # One pane for the selected plan instead of an expander per entry; options
+        # are entry keys so the selection follows the plan when entries are added
+        titles = {e['key']: e['title'] for e in visible}
+        selected = st.selectbox(
+            "Plan", list(titles), format_func=titles.get,
+            key="hist_selected", label_visibility="collapsed"
+        )
+        i = next(n for n, e in enumerate(visible) if e['key'] == selected)
+        entry = visible[i]
+        # Saved plans are listed by title; fetch the content when first selected
+        if entry['content_md'] is None:
+            entry = load_plan_by_id(entry['id']) or entry
+            ss.history[i] = entry
+        if entry['content_md'] is not None:
+            st.markdown(entry['content_md'] + "\n\n" + entry['caption_md'])
+        else:
+            st.markdown(entry['caption_md'])
+        if len(ss.history) > window:
+            st.button("Show older", key="btn_show_older", on_click=show_older_history)
+
+
 def main():
     # Apply background (reads from Streamlit secrets 'BACKGROUND_IMAGE_URL',
     # env 'BACKGROUND_IMAGE_URL', or local 'background.jpg' next to this file)
@@ -691,7 +1413,8 @@ def main():
             loaded = load_from_mongo(limit=20)
             if loaded:
                 st.session_state.history = loaded
-                st.session_state.latest_plan = loaded[0] if loaded else None
+                st.session_state.latest_plan = loaded[0]
+                st.session_state.history_last_id = loaded[0]['id']
         except Exception:
             pass
 
@@ -746,44 +1469,71 @@ def main():
             exact_ingredients = st.checkbox("Use ONLY these ingredients?", value=True, help="If checked, the AI will not use common pantry staples.")
         with col2:
             extra = st.text_input("Extra requirements?", placeholder="e.g., gluten-free, vegetarian")
+        variants = st.number_input(
+            "Number of plan variants",
+            min_value=1, max_value=3, value=1, step=1,
+            help="Generate several alternative plans at once."
+        )
+        allow_similar = semantic_cache_enabled() and st.checkbox(
+            "Allow similar-plan reuse",
+            value=False,
+            help="Reuse a recent plan generated for a nearly identical ingredient list instead of calling the AI again."
+        )
         submitted = st.form_submit_button("✨ Generate Meal Plan", use_container_width=True)
 
     if submitted:
-        if not ingredients.strip():
+        ingredients, limits = clean_ingredients(ingredients)
+        if not ingredients:
             st.error("Please enter at least one ingredient.")
         else:
+            if limits:
+                st.warning(f"Your ingredient list was shortened to fit the limit of {' and '.join(limits)}.")
             with st.spinner("🤖 Generating your personalized meal plan..."):
-                meal_plan = generate_meal_plan(
-                    ingredients=ingredients, kcal=kcal,
-                    exact_ingredients=exact_ingredients, extra=extra
+                prompt = {
+                    "ingredients": ingredients, "kcal": kcal,
+                    "exact_ingredients": exact_ingredients, "extra": extra,
+                }
+                meal_plans = generate_meal_plans(
+                    [prompt] * int(variants),
+                    allow_similar=allow_similar,
+                    stream_to=st.write_stream
                 )
-            if meal_plan:
-                try:
-                    *plan_body, titles_line = meal_plan.strip().split('\n')
+
+            new_entries = []
+            for meal_plan in meal_plans:
+                if isinstance(meal_plan, Exception):
+                    st.error(f"An error occurred while generating the meal plan: {meal_plan}")
+                    continue
+                if not meal_plan:
+                    continue
+                plan_body, sep, titles_line = meal_plan.strip().rpartition('\n')
+                if sep:
                     plan_title = titles_line.strip()
-                    plan_content = '\n'.join(plan_body).strip()
-                except ValueError:
+                    plan_content = plan_body.strip()
+                else:
                     plan_title = f"Plan based on {ingredients.splitlines()[0]}"
                     plan_content = meal_plan
 
-                history_entry = {
-                    "title": plan_title,
-                    "content": plan_content,
-                    "inputs": {
+                new_entries.append(build_history_entry(
+                    title=plan_title,
+                    content=plan_content,
+                    inputs={
                         "ingredients": ingredients, "kcal": kcal,
                         "exact_ingredients": exact_ingredients, "extra": extra,
                     }
-                }
-                st.session_state.latest_plan = history_entry
-                st.session_state.history.insert(0, history_entry)
+                ))
+
+            if new_entries:
+                st.session_state.latest_plan = new_entries[0]
+                st.session_state.history[:0] = new_entries
+                del st.session_state.history[MAX_HISTORY_ENTRIES:]
                 st.rerun()
 
     # Display latest plan
-    if st.session_state.latest_plan:
+    if st.session_state.latest_plan and st.session_state.latest_plan['plan_md'] is not None:
         st.subheader("📋 Your AI-Generated Meal Plan")
 
-        full_plan_text = st.session_state.latest_plan['content'] + "\n\n" + st.session_state.latest_plan['title']
-        st.markdown(full_plan_text.replace('\n', '  \n'))
+        st.markdown(st.session_state.latest_plan['plan_md'])
 
         if st.button("💾 Save Plan", use_container_width=True):
             with st.spinner("Saving your meal plan..."):
@@ -797,32 +1547,8 @@ def main():
                         st.error("❌ Failed to save plan. Please try again.")
 
     # Sidebar history
-    st.sidebar.title("📜 Your Generation History")
-    if st.sidebar.button("🔄 Refresh from Database"):
-        with st.spinner("Loading from database..."):
-            loaded = load_from_mongo(limit=50)
-            if loaded:
-                st.session_state.history = loaded
-                st.session_state.latest_plan = loaded[0] if loaded else None
-                st.success(f"✅ Loaded {len(loaded)} plans from your account.")
-            else:
-                st.info("No plans found in database.")
-
-    if st.sidebar.button("🗑️ Clear History"):
-        st.session_state.history = []
-        st.session_state.latest_plan = None
-        st.rerun()
-
-    if not st.session_state.history:
-        st.sidebar.info("Your generated meal plans will appear here.")
-    else:
-        for i, entry in enumerate(st.session_state.history):
-            with st.sidebar.expander(f"**{entry['title']}**"):
-                st.markdown(entry['content'].replace('\n', '  \n'))
-                st.caption(
-                    f"Kcal: {entry['inputs']['kcal']}, "
-                    f"Strict Ingredients: {'Yes' if entry['inputs']['exact_ingredients'] else 'No'}"
-                )
+    with st.sidebar:
+        show_history_sidebar()
 
 
 if __name__ == "__main__":